@@ -1,19 +1,39 @@
 from __future__ import annotations
 
 import argparse
+import datetime
+import itertools
 import os.path
-import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from typing import Any
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp  # type: ignore
 from google_auth_oauthlib.flow import InstalledAppFlow  # type: ignore
 from googleapiclient.discovery import build  # type: ignore
+from googleapiclient.errors import HttpError  # type: ignore
+from googleapiclient.http import build_http  # type: ignore
 
 from .messagestore import MessageStore
+from .ratelimiter import RateLimiter
 
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 DATABASE_NAME = "messages.sqlite3"
 OUTPUT_NAME = "messages.csv"
+# Gmail accepts up to 100 requests per batch but recommends no more than 50
+BATCH_SIZE = 50
+# Tokens expiring within this window are refreshed before any requests are made
+REFRESH_WINDOW = datetime.timedelta(minutes=5)
+# Gmail per-user quota units per second, and the cost of messages.list/get
+QUOTA_PER_SECOND = 250
+REQUEST_COST = 5
+# Responses worth retrying after a backoff, and how many times to try
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+MAX_RETRIES = 5
 
 
 def authenticate() -> Credentials:
@@ -33,14 +53,21 @@ def authenticate() -> Credentials:
     if os.path.exists("token.json"):
         creds = Credentials.from_authorized_user_file("token.json", SCOPES)
 
+    refreshed = False
+
+    # Credentials close to expiring are refreshed now to avoid a mid-run 401.
+    if creds and creds.refresh_token and (creds.expired or _expires_soon(creds)):
+        creds.refresh(Request())
+        refreshed = True
+
     # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
-            creds = flow.run_local_server(port=0)
-        # Save the credentials for the next run
+    elif not creds or not creds.valid:
+        flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
+        creds = flow.run_local_server(port=0)
+        refreshed = True
+
+    # Save the credentials for the next run, only when they have changed
+    if refreshed:
         with open("token.json", "w") as token:
             token.write(creds.to_json())
 
@@ -50,8 +77,31 @@ def authenticate() -> Credentials:
     return creds
 
 
+def _expires_soon(creds: Credentials) -> bool:
+    """Returns true if the credentials expire within the refresh window."""
+    if not creds.expiry:
+        return False
+
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return creds.expiry - now < REFRESH_WINDOW
+
+
+def build_service(creds: Credentials) -> Any:
+    """
+    Build the Gmail service used for all requests of a run.
+
+    The service is built once from the bundled discovery document and keeps a
+    single authorized http object so connections are reused between requests.
+
+    Args:
+        creds: Authentication Credentials
+    """
+    http = AuthorizedHttp(creds, http=build_http())
+    return build("gmail", "v1", http=http, cache_discovery=False)
+
+
 def build_message_list(
-    creds: Credentials,
+    service: Any,
     store: MessageStore,
     *,
     delay: float = 0.25,
@@ -61,96 +111,275 @@ def build_message_list(
     Builds a `messages.sqlite3` file which contains data for all messages.
 
     Args:
-        creds: Authentication Credentials
+        service: Gmail service, see `build_service`
         store: MessageStore object
-        delay: Number of seconds to pause between request
+        delay: Minimum number of seconds between each page request
         fullscan: When false, message collection stops when no new message ids are discovered
     """
-    service = build("gmail", "v1", credentials=creds)
-
-    next_page_token = ""
-    while "The Wild Things dance":
-        print(f"Fetching message ids. {store.row_count()} found so far...")
-        results = (
-            service.users()
-            .messages()
-            .list(
-                userId="me",
-                maxResults=500,
-                pageToken=next_page_token,
-            )
-            .execute()
+    limiter = RateLimiter(delay, rate=QUOTA_PER_SECOND)
+    seen_ids = store.load_seen_ids()
+
+    # A single worker requests the next page while the current page is
+    # saved. The executor waits on exit so the http object is never shared.
+    # All pages are saved in one transaction, committed once the sweep ends.
+    with store.bulk(), ThreadPoolExecutor(max_workers=1) as executor:
+        request = _list_message_request(service, "")
+        future = executor.submit(_execute, request, limiter, REQUEST_COST)
+
+        while "The Wild Things dance":
+            print(f"Fetching message ids. {len(seen_ids)} found so far...")
+            results = future.result()
+            next_page_token = results.get("nextPageToken", "")
+            new_ids: set[str] = {m["id"] for m in results.get("messages", [])}
+
+            if not fullscan and not new_ids - seen_ids:
+                print("All ids accounted for, assuming we have all ids and stopping.")
+                break
+
+            if next_page_token:
+                request = _list_message_request(service, next_page_token)
+                future = executor.submit(_execute, request, limiter, REQUEST_COST)
+
+            seen_ids |= new_ids
+            store.save_message_ids(new_ids)
+
+            if not next_page_token:
+                print("All ids captured")
+                break
+
+
+def _list_message_request(service: Any, page_token: str) -> Any:
+    """Build the message id list request for a single page."""
+    return (
+        service.users()
+        .messages()
+        .list(
+            userId="me",
+            maxResults=500,
+            pageToken=page_token,
         )
-        next_page_token = results.get("nextPageToken", "")
+    )
 
-        new_ids: set[str] = {message["id"] for message in results.get("messages", [])}
 
-        if not fullscan and not store.has_unique_ids(new_ids):
-            print("All ids accounted for, assuming we have all ids and stopping.")
-            break
+def hydrate_message_list(
+    service: Any,
+    store: MessageStore,
+    *,
+    delay: float = 0.25,
+    batch_size: int = BATCH_SIZE,
+) -> None:
+    """
+    Get details of any message id that has not already been fetched.
 
-        store.save_message_ids(new_ids)
+    Message details are requested through the Gmail batch endpoint, up to
+    `batch_size` messages per HTTP request. Messages that fail within a batch
+    with a rate limit or server error are requested again on their own, any
+    other failure is skipped. Batches are paced to the Gmail quota.
 
-        if not next_page_token:
-            print("All ids captured")
+    Args:
+        service: Gmail service, see `build_service`
+        store: MessageStore object
+        delay: Minimum number of seconds between each batch request
+        batch_size: Number of messages to request per batch (max 100)
+    """
+    limiter = RateLimiter(delay, rate=QUOTA_PER_SECOND)
+    message_ids = list(store.get_emtpy_message_ids())
+    to_fetch = len(message_ids)
+    pending = iter(message_ids)
+    fetched = 0
+    while "There and back again":
+        batch_ids = list(itertools.islice(pending, batch_size))
+        if not batch_ids:
             break
 
-        time.sleep(delay)
+        fetched += len(batch_ids)
+        print(f"Hydrating messages {fetched} of {to_fetch}.")
+
+        hydrated: dict[str, dict[str, Any]] = {}
+        failed: dict[str, Exception] = {}
+
+        def callback(request_id: str, response: Any, exception: Any) -> None:
+            if exception is not None:
+                failed[request_id] = exception
+            else:
+                hydrated[request_id] = response
+
+        batch = service.new_batch_http_request(callback=callback)
+        for messageid in batch_ids:
+            batch.add(_get_message_request(service, messageid), request_id=messageid)
+        _execute(batch, limiter, REQUEST_COST * len(batch_ids))
+
+        # Permanent failures, such as a message deleted since it was listed,
+        # are skipped and left unhydrated rather than aborting the run.
+        retryable = {mid: err for mid, err in failed.items() if _is_retryable(err)}
+        for messageid, err in failed.items():
+            if messageid not in retryable:
+                print(f"Skipping message {messageid}: {err}")
+
+        # Rate limited items will be rate limited again without a pause
+        if retryable:
+            limiter.backoff(_backoff_seconds(next(iter(retryable.values())), 0))
+
+        # Messages already fetched are saved even if a retry below raises
+        try:
+            for messageid in retryable:
+                print(f"Retrying message {messageid} individually.")
+                request = _get_message_request(service, messageid)
+                try:
+                    hydrated[messageid] = _execute(request, limiter, REQUEST_COST)
+
+                except HttpError as err:
+                    if _is_retryable(err):
+                        raise
+                    print(f"Skipping message {messageid}: {err}")
+
+        finally:
+            store.update_many(
+                (messageid, *_parse_message(results))
+                for messageid, results in hydrated.items()
+            )
 
 
-def hydrate_message_list(
+def hydrate_message_list_concurrent(
     creds: Credentials,
     store: MessageStore,
     *,
     delay: float = 0.25,
+    workers: int = 10,
 ) -> None:
     """
     Get details of any message id that has not already been fetched.
 
+    For use when the batch endpoint is not available. Messages are requested
+    one at a time from a pool of worker threads, each with its own service.
+    Requests are paced across all workers to the Gmail quota. Messages that
+    fail with anything but a rate limit or server error are skipped.
+
     Args:
         creds: Authentication Credentials
         store: MessageStore object
-        delay: Number of seconds to pause between request
+        delay: Minimum number of seconds between any two requests
+        workers: Number of concurrent requests
     """
-    service = build("gmail", "v1", credentials=creds)
-
-    to_fetch = store.row_count(only_empty=True)
-    for idx, messageid in enumerate(store.get_emtpy_message_ids(), start=1):
-        print(f"Hydrating message {idx} of {to_fetch}.")
-
-        results = (
-            service.users()
-            .messages()
-            .get(
-                userId="me",
-                id=messageid,
-                format="metadata",
-                metadataHeaders=["From", "Subject", "Delivered-To"],
-            )
-            .execute()
-        )
+    limiter = RateLimiter(delay, rate=QUOTA_PER_SECOND)
+    local = threading.local()
+
+    def fetch(message_id: str) -> dict[str, Any]:
+        # httplib2.Http is not thread-safe; each worker builds its own service
+        if not hasattr(local, "service"):
+            local.service = build_service(creds)
+        request = _get_message_request(local.service, message_id)
+        return _execute(request, limiter, REQUEST_COST)
+
+    message_ids = list(store.get_emtpy_message_ids())
+    to_fetch = len(message_ids)
+    rows: list[tuple[str, str, str, str, int, list[str]]] = []
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {executor.submit(fetch, mid): mid for mid in message_ids}
+        for idx, future in enumerate(as_completed(futures), start=1):
+            try:
+                rows.append((futures[future], *_parse_message(future.result())))
+
+            except HttpError as err:
+                if _is_retryable(err):
+                    raise
+                print(f"Skipping message {futures[future]}: {err}")
+
+            if len(rows) >= BATCH_SIZE or idx == to_fetch:
+                print(f"Hydrating messages {idx} of {to_fetch}.")
+                store.update_many(rows)
+                rows.clear()
+
+    finally:
+        # Messages already fetched are saved even if a request above raised
+        try:
+            if rows:
+                store.update_many(rows)
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+
+def _execute(request: Any, limiter: RateLimiter, cost: int) -> Any:
+    """
+    Execute a request or batch once the limiter allows it.
+
+    Rate limited and server error responses are retried after a backoff that
+    pauses every caller of the limiter.
+
+    Args:
+        request: Request or batch request to execute
+        limiter: RateLimiter shared by all requests of the run
+        cost: Quota units used by the request
+
+    Raises:
+        HttpError: When the error is not retryable or retries are exhausted
+    """
+    for attempt in itertools.count():
+        limiter.acquire(cost)
+        try:
+            return request.execute()
+
+        except HttpError as err:
+            if not _is_retryable(err) or attempt >= MAX_RETRIES:
+                raise
+
+            seconds = _backoff_seconds(err, attempt)
+            print(f"Request failed with {err.status_code}, retrying in {seconds:.1f}s.")
+            limiter.backoff(seconds)
+
+
+def _is_retryable(exception: Exception) -> bool:
+    """Returns true if the exception is a rate limit or server error."""
+    return isinstance(exception, HttpError) and exception.status_code in RETRY_STATUSES
 
-        message_data = {"Timestamp": results["internalDate"]}
-        for header in results["payload"]["headers"]:
-            if header["name"] == "From":
-                message_data["From"] = header["value"]
 
-            if header["name"] == "Subject":
-                message_data["Subject"] = header["value"]
+def _backoff_seconds(exception: Exception, attempt: int) -> float:
+    """Seconds to wait, honoring Retry-After or exponential backoff with jitter."""
+    if isinstance(exception, HttpError):
+        retry_after = exception.resp.get("retry-after", "")
+        if retry_after.isdigit():
+            return float(retry_after)
 
-            if header["name"] == "Delivered-To":
-                message_data["Delivered-To"] = header["value"]
+    return min(60.0, 2**attempt + random.random())
 
-        store.update(
-            message_id=messageid,
-            from_=message_data.get("From", ""),
-            delivered_to=message_data.get("Delivered-To", ""),
-            subject=message_data.get("Subject", ""),
-            timestamp=message_data.get("Timestamp", "0"),
-            label_ids=results.get("labelIds") or [],
+
+def _get_message_request(service: Any, message_id: str) -> Any:
+    """Build the metadata request for a single message id."""
+    return (
+        service.users()
+        .messages()
+        .get(
+            userId="me",
+            id=message_id,
+            format="metadata",
+            metadataHeaders=["From", "Subject", "Delivered-To"],
         )
+    )
+
+
+def _parse_message(results: dict[str, Any]) -> tuple[str, str, str, int, list[str]]:
+    """
+    Extract the stored fields from a message metadata response.
+
+    Returns:
+        Tuple of (from_, delivered_to, subject, timestamp, label_ids)
+    """
+    headers = _extract_headers(results)
+
+    return (
+        headers.get("From", ""),
+        headers.get("Delivered-To", ""),
+        headers.get("Subject", ""),
+        int(results["internalDate"]),
+        results.get("labelIds") or [],
+    )
 
-        time.sleep(delay)
+
+def _extract_headers(results: dict[str, Any]) -> dict[str, str]:
+    """Map header names to values. The last value wins for repeated headers."""
+    return {header["name"]: header["value"] for header in results["payload"]["headers"]}
 
 
 def parse_args(args: list[str] | None = None) -> argparse.Namespace:
@@ -168,7 +397,7 @@ def parse_args(args: list[str] | None = None) -> argparse.Namespace:
         default=0.25,
         type=float,
         metavar="",
-        help="Seconds delay between each request. Default: 0.25 seconds",
+        help="Minimum seconds between each request. Default: 0.25 seconds",
     )
     parser.add_argument(
         "--fullscan",
@@ -187,6 +416,14 @@ def parse_args(args: list[str] | None = None) -> argparse.Namespace:
         metavar="",
         help="Overwrite default export file name (messages.csv)",
     )
+    parser.add_argument(
+        "--workers",
+        action="store",
+        default=0,
+        type=int,
+        metavar="",
+        help="Hydrate with this many concurrent single message requests instead of the batch endpoint. Default: 0 (batch)",
+    )
 
     return parser.parse_args()
 
@@ -195,22 +432,34 @@ def main() -> int:
     """Main entry point."""
     args = parse_args()
 
-    store = MessageStore(args.database or DATABASE_NAME)
-    store.init_file()
-
-    if args.export:
-        if os.path.exists(args.output or OUTPUT_NAME):
-            if (
-                input(f"{args.output or OUTPUT_NAME} exists, overright? (y/N)").lower()
-                != "y"
-            ):
-                return 0
-        store.csv_export(args.output or OUTPUT_NAME, allow_overwrite=True)
-        return 0
-
-    creds = authenticate()
-    build_message_list(creds, store, delay=args.delay, fullscan=args.fullscan)
-    hydrate_message_list(creds, store, delay=args.delay)
+    with MessageStore(args.database or DATABASE_NAME) as store:
+        store.init_file()
+
+        if args.export:
+            if os.path.exists(args.output or OUTPUT_NAME):
+                if (
+                    input(
+                        f"{args.output or OUTPUT_NAME} exists, overright? (y/N)"
+                    ).lower()
+                    != "y"
+                ):
+                    return 0
+            store.csv_export(args.output or OUTPUT_NAME, allow_overwrite=True)
+            return 0
+
+        creds = authenticate()
+        service = build_service(creds)
+        build_message_list(service, store, delay=args.delay, fullscan=args.fullscan)
+
+        if args.workers:
+            hydrate_message_list_concurrent(
+                creds,
+                store,
+                delay=args.delay,
+                workers=args.workers,
+            )
+        else:
+            hydrate_message_list(service, store, delay=args.delay)
 
     return 0
 
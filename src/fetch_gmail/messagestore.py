@@ -2,6 +2,9 @@ from __future__ import annotations
 
 import contextlib
 import csv
+import functools
+import io
+import json
 import os
 import sqlite3
 from collections.abc import Generator
@@ -14,23 +17,83 @@ class MessageStore:
     def __init__(self, filename: str = "messages.sqlite3") -> None:
         """Create a message store. Use filename ":memory:" for a memory-only store."""
         self.filename = filename
+        self._conn: sqlite3.Connection | None = None
+        self._bulk_cursor: sqlite3.Cursor | None = None
+
+    def close(self) -> None:
+        """Close the cached connection, if open. Query planner stats are refreshed first."""
+        if self._conn is not None:
+            try:
+                self._conn.execute("PRAGMA optimize")
+
+            except sqlite3.Error:
+                # Stats are a best effort and must not mask an error in flight
+                pass
+
+            finally:
+                self._conn.close()
+                self._conn = None
+
+    def __enter__(self) -> MessageStore:
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
 
     def init_file(self) -> None:
-        """Initialize the file if required table does not exist."""
-        sql = """\
+        """
+        Initialize the file if required table does not exist.
+
+        Tables created before timestamps were stored as INTEGER are rebuilt
+        with the INTEGER column type.
+        """
+        pragma_sql = """\
             PRAGMA journal_mode=WAL;
+        """
+        table_sql = """\
             CREATE TABLE IF NOT EXISTS messages (
                 message_id TEXT UNIQUE,
                 [from] TEXT DEFAULT '',
                 delivered_to TEXT DEFAULT '',
                 subject TEXT DEFAULT '',
-                timestamp TEXT DEFAULT '0',
+                timestamp INTEGER DEFAULT 0,
                 label_ids TEXT DEFAULT ''
             );
         """
+        migrate_sql = """\
+            BEGIN;
+            ALTER TABLE messages RENAME TO messages_text_timestamp;
+            {table_sql}
+            INSERT INTO messages
+                SELECT
+                    message_id,
+                    [from],
+                    delivered_to,
+                    subject,
+                    CAST(timestamp AS INTEGER),
+                    label_ids
+                FROM messages_text_timestamp;
+            DROP TABLE messages_text_timestamp;
+            COMMIT;
+        """
+        index_sql = """\
+            CREATE INDEX IF NOT EXISTS idx_msg_empty
+                ON messages(timestamp, message_id)
+                WHERE timestamp=0;
+        """
 
-        with self._get_cursor() as cursor:
-            cursor.executescript(sql)
+        # journal_mode cannot change inside a transaction, so these scripts
+        # run on the connection directly and manage their own transactions.
+        connection = self._get_connection()
+        connection.executescript(pragma_sql + table_sql)
+
+        columns = connection.execute("PRAGMA table_info(messages)").fetchall()
+        # table_info rows are (cid, name, type, notnull, dflt_value, pk)
+        types = {column[1]: column[2] for column in columns}
+        if types["timestamp"] == "TEXT":
+            connection.executescript(migrate_sql.format(table_sql=table_sql))
+
+        connection.executescript(index_sql)
 
     def save_message_ids(self, ids: Iterable[str]) -> None:
         """
@@ -41,23 +104,31 @@ class MessageStore:
         Args:
             ids: Iterable of message ids
         """
-        sql = "INSERT OR IGNORE INTO messages (message_id) VALUES (?)"
+        # All ids are bound as a single JSON array and expanded by SQLite.
+        # Duplicates are dropped first, keeping order, to skip their probes.
+        sql = """\
+            INSERT OR IGNORE INTO messages (message_id)
+            SELECT value FROM json_each(?);
+        """
+        unique_ids = list(dict.fromkeys(ids))
 
         with self._get_cursor() as cursor:
-            cursor.executemany(sql, ((id_,) for id_ in ids))
+            cursor.execute(sql, (self._ids_to_json(unique_ids),))
 
     def update(
         self,
         message_id: str,
-        from_: str,
-        delivered_to: str,
-        subject: str,
-        timestamp: str,
-        label_ids: Iterable[str],
+        from_: str | None = None,
+        delivered_to: str | None = None,
+        subject: str | None = None,
+        timestamp: int | None = None,
+        label_ids: Iterable[str] | None = None,
     ) -> None:
         """
         Update table row details by message_id.
 
+        Only columns given a value are written, all others are left as is.
+
         Args:
             message_id: Must exist in the table already
             from_: Address message was delivered from (Header: From)
@@ -66,23 +137,57 @@ class MessageStore:
             timestamp: Local timestamp of message (internalDate)
             label_ids: An iterable of labels on the message
         """
-        sql = """\
-            UPDATE messages
-            SET
-                [from]=?,
-                delivered_to=?,
-                subject=?,
-                timestamp=?,
-                label_ids=?
-            WHERE message_id=?;
+        labels = None if label_ids is None else self._lables_to_csv(label_ids)
+        values = {
+            "[from]": from_,
+            "delivered_to": delivered_to,
+            "subject": subject,
+            "timestamp": timestamp,
+            "label_ids": labels,
+        }
+        columns = tuple(column for column, value in values.items() if value is not None)
+        if not columns:
+            return
+
+        sql = self._update_sql(columns)
+
+        with self._get_cursor() as cursor:
+            cursor.execute(sql, (*(values[column] for column in columns), message_id))
+
+    def update_many(
+        self,
+        rows: Iterable[tuple[str, str, str, str, int, Iterable[str]]],
+    ) -> None:
+        """
+        Update many table rows by message_id in a single transaction.
+
+        Args:
+            rows: Iterable of (message_id, from_, delivered_to, subject,
+                timestamp, label_ids) tuples. See `update` for details.
         """
-        labels = self._lables_to_csv(label_ids)
+        columns = ("[from]", "delivered_to", "subject", "timestamp", "label_ids")
+        sql = self._update_sql(columns)
+        values = (
+            (from_, delivered_to, subject, timestamp, self._lables_to_csv(labels), id_)
+            for id_, from_, delivered_to, subject, timestamp, labels in rows
+        )
 
         with self._get_cursor() as cursor:
-            cursor.execute(
-                sql,
-                (from_, delivered_to, subject, timestamp, labels, message_id),
-            )
+            cursor.executemany(sql, values)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=32)
+    def _update_sql(columns: tuple[str, ...]) -> str:
+        """
+        Build an UPDATE by message_id that sets only the given columns.
+
+        At most one statement is built per combination of the five columns.
+
+        Args:
+            columns: Column names to set, in parameter order
+        """
+        assignments = ",".join(f"{column}=?" for column in columns)
+        return f"UPDATE messages SET {assignments} WHERE message_id=?;"
 
     @staticmethod
     def _lables_to_csv(label_ids: Iterable[str]) -> str:
@@ -94,58 +199,65 @@ class MessageStore:
         Args:
             label_ids: An iterable of labels on the message
         """
-        clean_labels = []
-        for label in label_ids:
-            label = label.replace('"', '""')
-            if "," in label or '"' in label:
-                label = f'"{label}"'
-            clean_labels.append(label)
+        labels = list(label_ids)
+        joined = ",".join(labels)
 
-        return ",".join(clean_labels)
+        # Most labels need no quoting, a plain join is all that is required
+        if '"' not in joined and joined.count(",") == len(labels) - 1:
+            return joined
+
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="").writerow(labels)
+        return buffer.getvalue()
 
     @staticmethod
     def _csv_to_labels(csv_string: str) -> list[str]:
         """
-        Convert a stored csv of label ids back to a tuple of label ids
+        Convert a stored csv of label ids back to a list of label ids
 
         Follows RFC 4180 - excludes new line handling
 
         Args:
             csv_string: A stored string of label ids from table
         """
-        segments = []
-        in_quote = False
-        head = 0
-        for idx, char in enumerate(csv_string):
-            if char == '"':
-                in_quote = not in_quote
+        # Without quoting there is nothing to unescape, a plain split will do
+        if '"' not in csv_string:
+            return csv_string.split(",")
 
-            if not in_quote and char == ",":
-                segments.append(csv_string[head:idx])
-                head = idx + 1
+        return next(csv.reader([csv_string]))
 
-        segments.append(csv_string[head:])
+    def load_seen_ids(self) -> set[str]:
+        """Returns all message ids currently in the table."""
+        sql = "SELECT message_id FROM messages"
 
-        for idx, segment in enumerate(segments):
-            if segment.startswith('"') and segment.endswith('"'):
-                segment = segment[1 : len(segment) - 1]
-            segment = segment.replace('""', '"')
-            segments[idx] = segment
+        with self._get_cursor(readonly=True) as cursor:
+            results = cursor.execute(sql).fetchall()
 
-        return segments
+        return {row[0] for row in results}
 
     def has_unique_ids(self, ids: Iterable[str]) -> bool:
         """Returns true if any of the provided ids are unique to the table."""
-        ids_ = tuple(ids)
-        # sqlite3 does not support spreading values from one placeholder so
-        # this will create as many as provided.
-        ph = "?" + ",?" * (len(ids_) - 1)
-        sql = f"SELECT COUNT(message_id) FROM messages WHERE message_id IN ({ph})"
+        # All ids are bound as a single JSON array so the SQL text, and its
+        # prepared statement, is the same for any number of ids. The query
+        # stops at the first id that is not found in the table.
+        sql = """\
+            SELECT EXISTS (
+                SELECT 1 FROM json_each(?) AS ids
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM messages WHERE message_id=ids.value
+                )
+            );
+        """
 
-        with self._get_cursor() as cursor:
-            results = cursor.execute(sql, ids_).fetchone()
+        with self._get_cursor(readonly=True) as cursor:
+            results = cursor.execute(sql, (self._ids_to_json(ids),)).fetchone()
+
+        return bool(results[0])
 
-        return len(ids_) != results["COUNT(message_id)"]
+    @staticmethod
+    def _ids_to_json(ids: Iterable[str]) -> str:
+        """Encode message ids as a JSON array, copying only when not a list or tuple."""
+        return json.dumps(ids if isinstance(ids, (list, tuple)) else list(ids))
 
     def row_count(self, *, only_empty: bool = False) -> int:
         """
@@ -159,22 +271,21 @@ class MessageStore:
         else:
             sql = "SELECT COUNT(*) FROM messages"
 
-        with self._get_cursor() as cursor:
+        with self._get_cursor(readonly=True) as cursor:
             result = cursor.execute(sql).fetchone()
 
-        return result["COUNT(*)"]
+        return result[0]
 
     def get_emtpy_message_ids(self) -> Generator[str, None, None]:
         """Generate list of message ids that need to be hydrated."""
         sql = "SELECT message_id FROM messages WHERE timestamp=0;"
 
-        with self._get_cursor() as cursor:
+        with self._get_cursor(readonly=True) as cursor:
             results = cursor.execute(sql)
-            while "The road goes ever on and on":
-                row = results.fetchone()
-                if not row:
-                    break
-                yield row["message_id"]
+            results.arraysize = 1000
+            while rows := results.fetchmany():
+                for (message_id,) in rows:
+                    yield message_id
 
     def csv_export(self, filename: str, *, allow_overwrite: bool = False) -> None:
         """
@@ -191,45 +302,96 @@ class MessageStore:
             raise FileExistsError(f"'{filename}' already exists!")
 
         sql = "SELECT * FROM messages"
-        csvwriter = None
-        with self._get_cursor() as cursor:
+        with self._get_cursor(readonly=True) as cursor:
             results = cursor.execute(sql)
-            with open(filename, "w", encoding="utf-8") as outfile:
-
-                while "Mary had a little lamb":
-                    row = results.fetchone()
-                    if not row:
-                        break
-                    if not csvwriter:
-                        fieldnames = list(row.keys())
-                        csvwriter = csv.DictWriter(
-                            outfile,
-                            fieldnames=fieldnames,
-                            lineterminator="\n",
-                        )
-                        csvwriter.writeheader()
-
-                    csvwriter.writerow({k: row[k] for k in row.keys()})
+            results.arraysize = 1000
+            with open(
+                filename,
+                "w",
+                encoding="utf-8",
+                newline="",
+                buffering=1 << 20,
+            ) as outfile:
+                csvwriter = csv.writer(outfile, lineterminator="\n")
+                csvwriter.writerow([column[0] for column in results.description])
+                while rows := results.fetchmany():
+                    csvwriter.writerows(rows)
+
+    def _get_connection(self) -> sqlite3.Connection:
+        """Return the cached connection, opening it on first use."""
+        if self._conn is None:
+            try:
+                # Transactions are managed explicitly, see `_get_cursor`
+                connection = sqlite3.connect(
+                    self.filename,
+                    isolation_level=None,
+                    check_same_thread=False,
+                )
+                connection.executescript(
+                    """\
+                    PRAGMA synchronous=NORMAL;
+                    PRAGMA temp_store=MEMORY;
+                    PRAGMA cache_size=-64000;
+                    PRAGMA mmap_size=268435456;
+                    """
+                )
+
+            except sqlite3.OperationalError as err:
+                raise ConnectionError() from err
+
+            self._conn = connection
+
+        return self._conn
 
     @contextlib.contextmanager
-    def _get_cursor(self) -> Generator[sqlite3.Cursor, None, None]:
+    def bulk(self) -> Generator[MessageStore, None, None]:
         """
-        Context manager for returning a cursor after opening a connection.
+        Context manager that groups all writes into a single transaction.
+
+        Writes within the block share one cursor. Reads use their own so an
+        open read, such as `get_emtpy_message_ids`, is not reset by a write.
 
-        NOTE: auto commits on exit.
+        NOTE: commits on exit, including when an exception is raised.
         """
-        try:
-            connection = sqlite3.Connection(self.filename)
-            connection.row_factory = sqlite3.Row
+        connection = self._get_connection()
 
-        except sqlite3.OperationalError as err:
-            raise ConnectionError() from err
+        with contextlib.closing(connection.cursor()) as cursor:
+            cursor.execute("BEGIN IMMEDIATE")
+            self._bulk_cursor = cursor
 
-        try:
-            with contextlib.closing(connection.cursor()) as cursor:
-                yield cursor
+            try:
+                yield self
+
+            finally:
+                self._bulk_cursor = None
                 connection.commit()
 
-        finally:
-            connection.commit()
-            connection.close()
+    @contextlib.contextmanager
+    def _get_cursor(
+        self,
+        *,
+        readonly: bool = False,
+    ) -> Generator[sqlite3.Cursor, None, None]:
+        """
+        Context manager for returning a cursor from the cached connection.
+
+        Writes run in a transaction that commits on exit and rolls back on
+        error. Within `bulk()` the shared cursor and transaction are used.
+
+        Args:
+            readonly: When true no transaction is started or committed
+        """
+        if not readonly and self._bulk_cursor is not None:
+            yield self._bulk_cursor
+            return
+
+        connection = self._get_connection()
+
+        with contextlib.closing(connection.cursor()) as cursor:
+            if readonly:
+                yield cursor
+                return
+
+            cursor.execute("BEGIN")
+            with connection:
+                yield cursor
@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import math
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket limiter with a minimum interval between calls.
+
+    Each call to `acquire` spends `cost` tokens from a bucket refilled at `rate`
+    tokens per second. Calls are also spaced at least `interval` seconds apart
+    and can be paused for all callers with `backoff`.
+    """
+
+    def __init__(
+        self,
+        interval: float = 0.0,
+        *,
+        rate: float = math.inf,
+        capacity: float | None = None,
+    ) -> None:
+        """
+        Create a rate limiter.
+
+        Args:
+            interval: Minimum number of seconds between each acquire, across all threads
+            rate: Tokens added to the bucket per second. Default: unlimited
+            capacity: Size of the bucket. Default: one second of tokens
+        """
+        self.interval = interval
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+        # Generic cell rate algorithm: the bucket is tracked as the time it
+        # will next be full (`_full_at`) and its size in seconds of refill.
+        self._full_at = 0.0
+        self._tolerance = 1.0 if capacity is None else capacity / rate
+
+    def acquire(self, cost: float = 1.0) -> None:
+        """Block until the caller's slot is reached and `cost` tokens are available."""
+        increment = cost / self.rate
+
+        # A cost larger than the bucket waits only for a full bucket, then
+        # overdraws it, so the long run rate still matches `rate`.
+        wait = min(increment, self._tolerance) - self._tolerance
+
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot, self._full_at + wait)
+            self._full_at = max(self._full_at, slot) + increment
+            self._next_slot = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+    def backoff(self, seconds: float) -> None:
+        """Hold all callers for at least `seconds` from now."""
+        with self._lock:
+            self._next_slot = max(self._next_slot, time.monotonic() + seconds)
@@ -0,0 +1,379 @@
+from __future__ import annotations
+
+import datetime
+import sqlite3
+from collections.abc import Generator
+from typing import Any
+from unittest.mock import MagicMock
+from unittest.mock import mock_open
+from unittest.mock import patch
+
+import httplib2  # type: ignore
+import pytest
+from googleapiclient.errors import HttpError  # type: ignore
+
+from fetch_gmail import fetch_gmail
+from fetch_gmail.messagestore import MessageStore
+
+MESSAGE = {
+    "internalDate": "1700000000000",
+    "labelIds": ["INBOX"],
+    "payload": {
+        "headers": [
+            {"name": "From", "value": "from@example.com"},
+            {"name": "Delivered-To", "value": "to@example.com"},
+            {"name": "Subject", "value": "subject"},
+        ]
+    },
+}
+
+
+def _http_error(status: int, retry_after: str | None = None) -> HttpError:
+    headers = {"status": str(status)}
+    if retry_after is not None:
+        headers["retry-after"] = retry_after
+    return HttpError(httplib2.Response(headers), b"{}")
+
+
+class StubRequest:
+    """Request that raises each queued outcome in turn, then returns the last."""
+
+    def __init__(self, *outcomes: Any) -> None:
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def execute(self) -> Any:
+        outcome = self.outcomes[min(self.calls, len(self.outcomes) - 1)]
+        self.calls += 1
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class StubBatch:
+    """Batch that reports a queued outcome for each request id to the callback."""
+
+    def __init__(self, callback: Any, outcomes: dict[str, Any]) -> None:
+        self.callback = callback
+        self.outcomes = outcomes
+        self.request_ids: list[str] = []
+
+    def add(self, request: Any, request_id: str) -> None:
+        self.request_ids.append(request_id)
+
+    def execute(self) -> None:
+        for request_id in self.request_ids:
+            outcome = self.outcomes[request_id]
+            if isinstance(outcome, Exception):
+                self.callback(request_id, None, outcome)
+            else:
+                self.callback(request_id, outcome, None)
+
+
+class StubService:
+    """Gmail service where a batch and a single get can give different outcomes."""
+
+    def __init__(
+        self,
+        batch: dict[str, Any] | None = None,
+        single: dict[str, Any] | None = None,
+        pages: dict[str, Any] | None = None,
+    ) -> None:
+        self.batch = batch or {}
+        self.single = {key: StubRequest(value) for key, value in (single or {}).items()}
+        self.pages = pages or {}
+        self.page_tokens: list[str] = []
+
+    def list(self, *, pageToken: str, **kwargs: Any) -> StubRequest:
+        self.page_tokens.append(pageToken)
+        return StubRequest(self.pages[pageToken])
+
+    def users(self) -> StubService:
+        return self
+
+    def messages(self) -> StubService:
+        return self
+
+    def get(self, *, id: str, **kwargs: Any) -> StubRequest:
+        return self.single.get(id, StubRequest(MESSAGE))
+
+    def new_batch_http_request(self, callback: Any) -> StubBatch:
+        return StubBatch(callback, self.batch)
+
+
+@pytest.fixture
+def limiter() -> MagicMock:
+    return MagicMock(spec=fetch_gmail.RateLimiter)
+
+
+@pytest.fixture
+def store() -> MagicMock:
+    store = MagicMock(spec=fetch_gmail.MessageStore)
+    store.saved = []
+    store.update_many.side_effect = lambda rows: store.saved.extend(rows)
+    return store
+
+
+@pytest.fixture
+def sqlite_store(tmpdir) -> Generator[MessageStore, None, None]:
+    store = MessageStore(tmpdir.join("fetch_gmail_test_database"))
+
+    try:
+        store.init_file()
+        yield store
+
+    finally:
+        store.close()
+
+
+def _page(ids: str, next_page_token: str = "") -> dict[str, Any]:
+    page: dict[str, Any] = {"messages": [{"id": messageid} for messageid in ids]}
+    if next_page_token:
+        page["nextPageToken"] = next_page_token
+    return page
+
+
+PAGES = {
+    "": _page("ab", "p2"),
+    "p2": _page("cd", "p3"),
+    "p3": _page("ef", "p4"),
+    "p4": _page("gh"),
+}
+
+
+def test_build_message_list_fullscan_saves_every_page(
+    limiter: MagicMock,
+    sqlite_store: MessageStore,
+) -> None:
+    service = StubService(pages=PAGES)
+
+    with patch.object(fetch_gmail, "RateLimiter", return_value=limiter):
+        fetch_gmail.build_message_list(service, sqlite_store, fullscan=True)
+
+    assert sqlite_store.load_seen_ids() == set("abcdefgh")
+    assert service.page_tokens == ["", "p2", "p3", "p4"]
+
+
+def test_build_message_list_stops_without_requesting_next_page(
+    limiter: MagicMock,
+    sqlite_store: MessageStore,
+) -> None:
+    sqlite_store.save_message_ids("cdef")
+    service = StubService(pages=PAGES)
+
+    with patch.object(fetch_gmail, "RateLimiter", return_value=limiter):
+        fetch_gmail.build_message_list(service, sqlite_store)
+
+    assert sqlite_store.load_seen_ids() == set("abcdef")
+    assert service.page_tokens == ["", "p2"]
+
+
+def test_build_message_list_commits_pages_before_error(
+    limiter: MagicMock,
+    sqlite_store: MessageStore,
+) -> None:
+    service = StubService(pages={**PAGES, "p3": _http_error(404)})
+
+    with patch.object(fetch_gmail, "RateLimiter", return_value=limiter):
+        with pytest.raises(HttpError):
+            fetch_gmail.build_message_list(service, sqlite_store, fullscan=True)
+
+    conn = sqlite3.connect(sqlite_store.filename)
+    results = conn.execute("SELECT message_id FROM messages").fetchall()
+    conn.close()
+
+    assert {r[0] for r in results} == set("abcd")
+
+
+def _credentials(
+    *,
+    valid: bool,
+    refresh_token: str | None,
+    expires_in: datetime.timedelta,
+) -> MagicMock:
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    creds = MagicMock(spec=fetch_gmail.Credentials)
+    creds.valid = valid
+    creds.expired = expires_in <= datetime.timedelta()
+    creds.refresh_token = refresh_token
+    creds.expiry = now + expires_in
+    return creds
+
+
+@pytest.mark.parametrize(
+    ("token_file", "valid", "refresh_token", "expires_in", "refreshed", "flowed"),
+    (
+        (True, True, "refresh", datetime.timedelta(hours=1), False, False),
+        (True, True, "refresh", datetime.timedelta(minutes=1), True, False),
+        (True, True, None, datetime.timedelta(minutes=1), False, False),
+        (True, False, "refresh", datetime.timedelta(minutes=-1), True, False),
+        (True, False, None, datetime.timedelta(minutes=-1), False, True),
+        (False, False, None, datetime.timedelta(), False, True),
+    ),
+)
+def test_authenticate(
+    token_file: bool,
+    valid: bool,
+    refresh_token: str | None,
+    expires_in: datetime.timedelta,
+    refreshed: bool,
+    flowed: bool,
+) -> None:
+    creds = _credentials(
+        valid=valid, refresh_token=refresh_token, expires_in=expires_in
+    )
+    flow_creds = MagicMock(spec=fetch_gmail.Credentials)
+
+    with patch("os.path.exists", return_value=token_file):
+        with patch.object(
+            fetch_gmail.Credentials, "from_authorized_user_file", return_value=creds
+        ) as from_file:
+            with patch.object(fetch_gmail, "InstalledAppFlow") as mock_flow:
+                flow = mock_flow.from_client_secrets_file.return_value
+                flow.run_local_server.return_value = flow_creds
+                with patch("builtins.open", mock_open()) as mock_file:
+                    result = fetch_gmail.authenticate()
+
+    assert result is (flow_creds if flowed else creds)
+    assert from_file.called is token_file
+    assert creds.refresh.called is refreshed
+    assert flow.run_local_server.called is flowed
+    assert mock_file.called is (refreshed or flowed)
+    if refreshed or flowed:
+        mock_file().write.assert_called_once_with(result.to_json())
+
+
+def test_execute_returns_result(limiter: MagicMock) -> None:
+    request = StubRequest({"id": "1"})
+
+    result = fetch_gmail._execute(request, limiter, 5)
+
+    assert result == {"id": "1"}
+    limiter.acquire.assert_called_once_with(5)
+    limiter.backoff.assert_not_called()
+
+
+@pytest.mark.parametrize("status", [429, 500, 502, 503, 504])
+def test_execute_retries_retryable_status(limiter: MagicMock, status: int) -> None:
+    request = StubRequest(_http_error(status, "3"), {"id": "1"})
+
+    result = fetch_gmail._execute(request, limiter, 5)
+
+    assert result == {"id": "1"}
+    assert request.calls == 2
+    limiter.backoff.assert_called_once_with(3.0)
+
+
+@pytest.mark.parametrize("status", [400, 403, 404])
+def test_execute_raises_non_retryable_status(limiter: MagicMock, status: int) -> None:
+    request = StubRequest(_http_error(status))
+
+    with pytest.raises(HttpError):
+        fetch_gmail._execute(request, limiter, 5)
+
+    assert request.calls == 1
+    limiter.backoff.assert_not_called()
+
+
+def test_execute_gives_up_after_max_retries(limiter: MagicMock) -> None:
+    request = StubRequest(_http_error(503, "1"))
+
+    with pytest.raises(HttpError):
+        fetch_gmail._execute(request, limiter, 5)
+
+    assert request.calls == fetch_gmail.MAX_RETRIES + 1
+    assert limiter.backoff.call_count == fetch_gmail.MAX_RETRIES
+
+
+@pytest.mark.parametrize(
+    ("exception", "expected"),
+    (
+        (_http_error(429), True),
+        (_http_error(503), True),
+        (_http_error(404), False),
+        (Exception("boom"), False),
+    ),
+)
+def test_is_retryable(exception: Exception, expected: bool) -> None:
+    assert fetch_gmail._is_retryable(exception) is expected
+
+
+def test_backoff_seconds_honors_retry_after() -> None:
+    assert fetch_gmail._backoff_seconds(_http_error(429, "7"), 3) == 7.0
+
+
+@pytest.mark.parametrize("retry_after", [None, "Wed, 21 Oct 2015 07:28:00 GMT"])
+def test_backoff_seconds_falls_back_to_jitter(retry_after: str | None) -> None:
+    with patch("random.random", return_value=0.5):
+        seconds = fetch_gmail._backoff_seconds(_http_error(503, retry_after), 3)
+
+    assert seconds == 8.5
+
+
+def test_backoff_seconds_is_capped() -> None:
+    with patch("random.random", return_value=0.5):
+        seconds = fetch_gmail._backoff_seconds(_http_error(503), 10)
+
+    assert seconds == 60.0
+
+
+def test_hydrate_message_list_retries_only_retryable_failures(
+    limiter: MagicMock,
+    store: MagicMock,
+) -> None:
+    store.get_emtpy_message_ids.return_value = iter(["ok", "limited", "deleted"])
+    service = StubService(
+        batch={
+            "ok": MESSAGE,
+            "limited": _http_error(429, "2"),
+            "deleted": _http_error(404),
+        },
+        single={"limited": MESSAGE, "deleted": MESSAGE},
+    )
+
+    with patch.object(fetch_gmail, "RateLimiter", return_value=limiter):
+        fetch_gmail.hydrate_message_list(service, store)
+
+    assert [row[0] for row in store.saved] == ["ok", "limited"]
+    assert service.single["deleted"].calls == 0
+    limiter.backoff.assert_called_once_with(2.0)
+
+
+def test_hydrate_message_list_saves_batch_when_retry_fails(
+    limiter: MagicMock,
+    store: MagicMock,
+) -> None:
+    store.get_emtpy_message_ids.return_value = iter(["ok", "limited"])
+    service = StubService(
+        batch={"ok": MESSAGE, "limited": _http_error(503, "1")},
+        single={"limited": _http_error(503, "1")},
+    )
+
+    with patch.object(fetch_gmail, "RateLimiter", return_value=limiter):
+        with pytest.raises(HttpError):
+            fetch_gmail.hydrate_message_list(service, store)
+
+    assert [row[0] for row in store.saved] == ["ok"]
+
+
+def test_hydrate_message_list_concurrent_saves_rows_and_skips_failures(
+    limiter: MagicMock,
+    store: MagicMock,
+) -> None:
+    message_ids = [str(idx) for idx in range(120)] + ["deleted", "unavailable"]
+    store.get_emtpy_message_ids.return_value = iter(message_ids)
+    service = StubService(
+        single={"deleted": _http_error(404), "unavailable": _http_error(503, "1")}
+    )
+
+    with patch.object(fetch_gmail, "RateLimiter", return_value=limiter):
+        with patch.object(fetch_gmail, "build_service", return_value=service) as build:
+            with pytest.raises(HttpError):
+                fetch_gmail.hydrate_message_list_concurrent(
+                    MagicMock(), store, workers=1
+                )
+
+    assert [row[0] for row in store.saved] == message_ids[:120]
+    assert store.update_many.call_count == 3
+    assert service.single["unavailable"].calls == fetch_gmail.MAX_RETRIES + 1
+    build.assert_called_once()
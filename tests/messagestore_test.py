@@ -3,6 +3,7 @@ from __future__ import annotations
 import os
 import sqlite3
 from collections.abc import Generator
+from unittest.mock import MagicMock
 
 import pytest
 
@@ -19,6 +20,7 @@ def store(tmpdir) -> Generator[MessageStore, None, None]:
         yield store
 
     finally:
+        store.close()
         os.remove(tempfile)
 
 
@@ -41,6 +43,75 @@ def test_init_file(store: MessageStore) -> None:
     assert columns == expected
 
 
+@pytest.mark.parametrize(
+    "pragma,expected",
+    (
+        ("journal_mode", "wal"),
+        ("synchronous", 1),
+        ("temp_store", 2),
+        ("cache_size", -64000),
+    ),
+)
+def test_connection_pragmas(store: MessageStore, pragma: str, expected: object) -> None:
+    with store._get_cursor(readonly=True) as cursor:
+        result = cursor.execute(f"PRAGMA {pragma}").fetchone()
+
+    assert result[0] == expected
+
+
+def test_init_file_migrates_text_timestamp(tmpdir) -> None:
+    tempfile = tmpdir.join("messagestore_test_migration")
+    conn = sqlite3.connect(tempfile)
+    conn.executescript(
+        """\
+        CREATE TABLE messages (
+            message_id TEXT UNIQUE,
+            [from] TEXT DEFAULT '',
+            delivered_to TEXT DEFAULT '',
+            subject TEXT DEFAULT '',
+            timestamp TEXT DEFAULT '0',
+            label_ids TEXT DEFAULT ''
+        );
+        INSERT INTO messages VALUES ('123', 'm', 'm', 'm', '8675309', 'hi');
+        INSERT INTO messages (message_id) VALUES ('456');
+        """
+    )
+    conn.close()
+    store = MessageStore(tempfile)
+
+    try:
+        store.init_file()
+        conn = sqlite3.connect(tempfile)
+        columns = conn.execute("PRAGMA table_info(messages)").fetchall()
+        results = conn.execute("SELECT * FROM messages").fetchall()
+        conn.close()
+
+        assert {c[1]: c[2] for c in columns}["timestamp"] == "INTEGER"
+        assert results == [
+            ("123", "m", "m", "m", 8675309, "hi"),
+            ("456", "", "", "", 0, ""),
+        ]
+        assert store.row_count(only_empty=True) == 1
+
+    finally:
+        store.close()
+
+
+@pytest.mark.parametrize(
+    "sql",
+    (
+        "SELECT COUNT(*) FROM messages WHERE timestamp=0",
+        "SELECT message_id FROM messages WHERE timestamp=0",
+    ),
+)
+def test_only_empty_queries_use_covering_index(store: MessageStore, sql: str) -> None:
+    conn = sqlite3.connect(store.filename)
+
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+
+    assert "COVERING INDEX idx_msg_empty" in plan[0][-1]
+
+
 def test_save_messages_ignores_constraint_violations(store: MessageStore) -> None:
     ids = ["123", "456", "789"]
     sql = "SELECT * from messages;"
@@ -53,28 +124,194 @@ def test_save_messages_ignores_constraint_violations(store: MessageStore) -> Non
     assert ids == [r[0] for r in results]
 
 
+def test_close_releases_connection(store: MessageStore) -> None:
+    store.row_count()
+    assert store._conn is not None
+
+    store.close()
+
+    assert store._conn is None
+    assert store.row_count() == 0
+
+
+def test_close_releases_connection_when_optimize_fails(store: MessageStore) -> None:
+    store.close()
+    conn = MagicMock()
+    conn.execute.side_effect = sqlite3.OperationalError("database is locked")
+    store._conn = conn
+
+    store.close()
+
+    conn.close.assert_called_once()
+    assert store._conn is None
+
+
+def test_context_manager_closes_connection(tmpdir) -> None:
+    tempfile = tmpdir.join("messagestore_test_database")
+
+    with MessageStore(tempfile) as store:
+        store.init_file()
+        store.save_message_ids(["123"])
+
+    assert store._conn is None
+    assert sqlite3.connect(tempfile).execute("SELECT * FROM messages").fetchone()
+
+
+def test_save_messages_drops_duplicates_in_order(store: MessageStore) -> None:
+    ids = ["123", "456", "123", "789", "456"]
+    sql = "SELECT message_id from messages;"
+    conn = sqlite3.connect(store.filename)
+
+    store.save_message_ids(ids)
+    results = conn.execute(sql).fetchall()
+
+    assert [r[0] for r in results] == ["123", "456", "789"]
+
+
 def test_update(store: MessageStore) -> None:
     ids = ["123", "456", "789"]
     sql = "SELECT * from messages WHERE message_id=456;"
     conn = sqlite3.connect(store.filename)
     store.save_message_ids(ids)
 
-    store.update("456", "mockfrom", "mockto", "mocksub", "8675309", ["hi", "there"])
+    store.update("456", "mockfrom", "mockto", "mocksub", 8675309, ["hi", "there"])
     results = conn.execute(sql).fetchone()
 
-    assert results == ("456", "mockfrom", "mockto", "mocksub", "8675309", "hi,there")
+    assert results == ("456", "mockfrom", "mockto", "mocksub", 8675309, "hi,there")
+
+
+def test_update_only_given_columns(store: MessageStore) -> None:
+    sql = "SELECT * from messages WHERE message_id=456;"
+    conn = sqlite3.connect(store.filename)
+    store.save_message_ids(["456"])
+    store.update("456", "mockfrom", "mockto", "mocksub", 8675309, ["hi"])
+
+    store.update("456", timestamp=9035768, label_ids=["there"])
+    results = conn.execute(sql).fetchone()
+
+    assert results == ("456", "mockfrom", "mockto", "mocksub", 9035768, "there")
+
+
+def test_update_without_columns_is_noop(store: MessageStore) -> None:
+    store.save_message_ids(["456"])
+    statements: list[str] = []
+    store._get_connection().set_trace_callback(statements.append)
+
+    store.update("456")
+
+    assert not statements
 
 
 def test_update_does_not_insert_if_id_not_exists(store: MessageStore) -> None:
     sql = "SELECT * from messages WHERE message_id=456;"
     conn = sqlite3.connect(store.filename)
 
-    store.update("456", "mockfrom", "mockto", "mocksub", "8675309", [])
+    store.update("456", "mockfrom", "mockto", "mocksub", 8675309, [])
     results = conn.execute(sql).fetchone()
 
     assert not results
 
 
+def test_update_many(store: MessageStore) -> None:
+    ids = ["123", "456", "789"]
+    sql = "SELECT * from messages WHERE message_id IN (123, 789);"
+    conn = sqlite3.connect(store.filename)
+    store.save_message_ids(ids)
+    rows = [
+        ("123", "mockfrom", "mockto", "mocksub", 8675309, ["hi", "there"]),
+        ("789", "mockfrom2", "mockto2", "mocksub2", 9035768, []),
+    ]
+
+    store.update_many(rows)
+    results = conn.execute(sql).fetchall()
+
+    assert results == [
+        ("123", "mockfrom", "mockto", "mocksub", 8675309, "hi,there"),
+        ("789", "mockfrom2", "mockto2", "mocksub2", 9035768, ""),
+    ]
+    assert store.row_count(only_empty=True) == 1
+
+
+def test_load_seen_ids(store: MessageStore) -> None:
+    ids = ["123", "456", "789"]
+    store.save_message_ids(ids)
+
+    result = store.load_seen_ids()
+
+    assert result == set(ids)
+
+
+def test_bulk_commits_once_on_exit(store: MessageStore) -> None:
+    sql = "SELECT COUNT(*) FROM messages;"
+    conn = sqlite3.connect(store.filename)
+
+    with store.bulk() as bulk:
+        bulk.save_message_ids(["123", "456"])
+        bulk.save_message_ids(["789"])
+        bulk.update("123", "m", "m", "m", 1, [])
+        inside = conn.execute(sql).fetchone()
+
+    outside = conn.execute(sql).fetchone()
+
+    assert inside == (0,)
+    assert outside == (3,)
+    assert store.row_count(only_empty=True) == 2
+
+
+def test_bulk_shares_one_cursor_for_writes(store: MessageStore) -> None:
+    with store.bulk():
+        with store._get_cursor() as first:
+            pass
+        with store._get_cursor() as second:
+            pass
+        with store._get_cursor(readonly=True) as read:
+            pass
+
+    assert first is second
+    assert read is not first
+
+
+def test_bulk_reads_are_not_reset_by_writes(store: MessageStore) -> None:
+    ids = [str(id_) for id_ in range(2500)]
+    store.save_message_ids(ids)
+
+    with store.bulk():
+        for id_ in store.get_emtpy_message_ids():
+            store.update(id_, "m", "m", "m", 1, [])
+
+    assert store.row_count(only_empty=True) == 0
+
+
+def test_update_many_rolls_back_on_error(store: MessageStore) -> None:
+    store.save_message_ids(["123", "456"])
+
+    def rows():
+        yield ("123", "m", "m", "m", 1, [])
+        raise ValueError("mock failure")
+
+    with pytest.raises(ValueError):
+        store.update_many(rows())
+
+    assert store.row_count(only_empty=True) == 2
+    assert not store._get_connection().in_transaction
+
+
+def test_reads_do_not_begin_or_commit(store: MessageStore, tmpdir) -> None:
+    store.save_message_ids(["123", "456", "789"])
+    statements: list[str] = []
+    store._get_connection().set_trace_callback(statements.append)
+
+    store.load_seen_ids()
+    store.has_unique_ids(["123"])
+    store.row_count()
+    store.row_count(only_empty=True)
+    list(store.get_emtpy_message_ids())
+    store.csv_export(tmpdir.join("messagestore_test_export"))
+
+    assert statements
+    assert not [s for s in statements if s.startswith(("BEGIN", "COMMIT"))]
+
+
 def test_has_unique_ids_is_false(store: MessageStore) -> None:
     ids = ["123", "456", "789"]
     store.save_message_ids(ids)
@@ -93,6 +330,37 @@ def test_has_unique_ids_is_true(store: MessageStore) -> None:
     assert result is True
 
 
+def test_has_unique_ids_is_true_with_partial_overlap(store: MessageStore) -> None:
+    ids = ["123", "456", "789"]
+    store.save_message_ids(ids)
+
+    result = store.has_unique_ids(["123", "456", "134", "789"])
+
+    assert result is True
+
+
+def test_has_unique_ids_above_variable_limit(store: MessageStore) -> None:
+    ids = [str(id_) for id_ in range(40_000)]
+    store.save_message_ids(ids)
+
+    assert store.has_unique_ids(ids) is False
+    assert store.has_unique_ids(ids + ["unique"]) is True
+
+
+def test_has_unique_ids_is_false_when_empty(store: MessageStore) -> None:
+    result = store.has_unique_ids([])
+
+    assert result is False
+
+
+def test_has_unique_ids_accepts_generator(store: MessageStore) -> None:
+    ids = ["123", "456", "789"]
+    store.save_message_ids(id_ for id_ in ids)
+
+    assert store.has_unique_ids(id_ for id_ in ids) is False
+    assert store.has_unique_ids(id_ for id_ in ["134"]) is True
+
+
 def test_row_count(store: MessageStore) -> None:
     ids = ["123", "456", "789"]
     store.save_message_ids(ids)
@@ -105,7 +373,7 @@ def test_row_count(store: MessageStore) -> None:
 def test_row_count_only_empty(store: MessageStore) -> None:
     ids = ["123", "456", "789"]
     store.save_message_ids(ids)
-    store.update("123", "m", "m", "m", "1", [])
+    store.update("123", "m", "m", "m", 1, [])
 
     result = store.row_count(only_empty=True)
 
@@ -122,6 +390,15 @@ def test_get_empty_mesages_ids(store: MessageStore) -> None:
     assert idx == len(ids)
 
 
+def test_get_empty_message_ids_spans_fetch_batches(store: MessageStore) -> None:
+    ids = [str(id_) for id_ in range(2500)]
+    store.save_message_ids(ids)
+
+    result = list(store.get_emtpy_message_ids())
+
+    assert sorted(result) == sorted(ids)
+
+
 def test_csv_export(store: MessageStore, tmpdir) -> None:
     ids = ["123", "456", "789"]
     store.save_message_ids(ids)
@@ -145,6 +422,26 @@ message_id,from,delivered_to,subject,timestamp,label_ids
         os.remove(tempfile)
 
 
+def test_csv_export_empty_table_writes_header(store: MessageStore, tmpdir) -> None:
+    tempfile = tmpdir.join("messagestore_test_export")
+    expected = "message_id,from,delivered_to,subject,timestamp,label_ids\n"
+
+    store.csv_export(tempfile)
+
+    with open(tempfile, "r", encoding="utf-8") as infile:
+        contents = infile.read()
+
+    assert contents == expected
+
+
+def test_csv_export_raises_when_file_exists(store: MessageStore, tmpdir) -> None:
+    tempfile = tmpdir.join("messagestore_test_export")
+    tempfile.write("")
+
+    with pytest.raises(FileExistsError):
+        store.csv_export(tempfile)
+
+
 @pytest.mark.parametrize(
     "label_ids,expected",
     (
@@ -154,6 +451,8 @@ message_id,from,delivered_to,subject,timestamp,label_ids
         (["aaa", "b,bb", "ccc"], 'aaa,"b,bb",ccc'),
         (["a'a'a", "b,bb", 'c"c"c'], 'a\'a\'a,"b,bb","c""c""c"'),
         (["", "", ""], ",,"),
+        ([""], ""),
+        ([], ""),
     ),
 )
 def test_lables_to_csv(
@@ -174,8 +473,9 @@ def test_lables_to_csv(
         ('"""aaa",bbb,ccc', ['"aaa', "bbb", "ccc"]),
         ('"aaa""",bbb,ccc', ['aaa"', "bbb", "ccc"]),
         ('aaa,"b,bb",ccc', ["aaa", "b,bb", "ccc"]),
-        ('a\'a\'a,"b,bb",c""c""c', ["a'a'a", "b,bb", 'c"c"c']),
+        ('a\'a\'a,"b,bb","c""c""c"', ["a'a'a", "b,bb", 'c"c"c']),
         (",,", ["", "", ""]),
+        ("", [""]),
     ),
 )
 def test_csv_to_lables(
@@ -187,3 +487,17 @@ def test_csv_to_lables(
     result = store._csv_to_labels(csv_string)
 
     assert result == expected
+
+
+@pytest.mark.parametrize(
+    "label_ids",
+    (
+        ["INBOX", "UNREAD"],
+        ['"aaa', "b,bb", 'c"c"c', '""'],
+        ["", "", ""],
+    ),
+)
+def test_labels_round_trip(store: MessageStore, label_ids: list[str]) -> None:
+    result = store._csv_to_labels(store._lables_to_csv(label_ids))
+
+    assert result == label_ids
@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import threading
+from unittest.mock import patch
+
+from fetch_gmail.ratelimiter import RateLimiter
+
+
+def test_acquire_does_not_wait_for_first_call() -> None:
+    limiter = RateLimiter(10.0)
+
+    with patch("time.sleep") as mock_sleep:
+        limiter.acquire()
+
+    mock_sleep.assert_not_called()
+
+
+def test_acquire_spaces_calls_by_interval() -> None:
+    limiter = RateLimiter(10.0)
+
+    with patch("time.monotonic", return_value=100.0):
+        with patch("time.sleep") as mock_sleep:
+            limiter.acquire()
+            limiter.acquire()
+            limiter.acquire()
+
+    assert [c.args[0] for c in mock_sleep.call_args_list] == [10.0, 20.0]
+
+
+def test_acquire_is_shared_across_threads() -> None:
+    limiter = RateLimiter(10.0)
+
+    with patch("time.monotonic", return_value=100.0):
+        with patch("time.sleep") as mock_sleep:
+            threads = [threading.Thread(target=limiter.acquire) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+    assert sorted(c.args[0] for c in mock_sleep.call_args_list) == [10.0, 20.0, 30.0]
+
+
+def test_acquire_allows_burst_up_to_capacity() -> None:
+    limiter = RateLimiter(rate=10.0, capacity=20.0)
+
+    with patch("time.monotonic", return_value=100.0):
+        with patch("time.sleep") as mock_sleep:
+            for _ in range(5):
+                limiter.acquire(cost=5.0)
+
+    assert [c.args[0] for c in mock_sleep.call_args_list] == [0.5]
+
+
+def test_acquire_refills_over_time() -> None:
+    limiter = RateLimiter(rate=10.0, capacity=10.0)
+
+    with patch("time.sleep") as mock_sleep:
+        with patch("time.monotonic", return_value=100.0):
+            limiter.acquire(cost=10.0)
+        with patch("time.monotonic", return_value=101.0):
+            limiter.acquire(cost=10.0)
+
+    mock_sleep.assert_not_called()
+
+
+def test_acquire_uses_larger_of_interval_and_rate() -> None:
+    limiter = RateLimiter(2.0, rate=10.0, capacity=10.0)
+
+    with patch("time.monotonic", return_value=100.0):
+        with patch("time.sleep") as mock_sleep:
+            limiter.acquire(cost=1.0)
+            limiter.acquire(cost=1.0)
+
+    assert [c.args[0] for c in mock_sleep.call_args_list] == [2.0]
+
+
+def test_backoff_holds_next_acquire() -> None:
+    limiter = RateLimiter()
+
+    with patch("time.monotonic", return_value=100.0):
+        with patch("time.sleep") as mock_sleep:
+            limiter.acquire()
+            limiter.backoff(30.0)
+            limiter.acquire()
+
+    assert [c.args[0] for c in mock_sleep.call_args_list] == [30.0]
+
+
+def test_acquire_cost_above_capacity_keeps_rate() -> None:
+    limiter = RateLimiter(rate=250.0, capacity=250.0)
+
+    with patch("time.monotonic", return_value=100.0):
+        with patch("time.sleep") as mock_sleep:
+            for _ in range(3):
+                limiter.acquire(cost=500.0)
+
+    assert [c.args[0] for c in mock_sleep.call_args_list] == [2.0, 4.0]